@@ -13,3 +13,20 @@ SUBJECT_SEARCH_STRING = ['cs daily Subj-class mailing']
 INDEX_DIR = 'index'
 OUTPUT_DIR = 'output'
 PAPER_CACHE_DIR = 'cache'
+ARXIV_REQUESTS_PER_SECOND = 1 / 3
+ARXIV_REQUEST_BURST = 1
+ARXIV_WORKERS = 4
+# arXiv's API terms allow a single connection at a time, more workers only overlap parsing and indexing
+ARXIV_MAX_CONNECTIONS = 1
+ARXIV_CHUNK_RETRIES = 3
+ARXIV_MAX_CONSECUTIVE_FAILURES = 5
+ARXIV_RETRY_BACKOFF_SECONDS = 3
+ARXIV_CACHE_FILE = 'arxiv_papers.jsonl'
+METADATA_STORE_FILE = 'arxiv_metadata.sqlite'
+DEDUPLICATE_PAPERS = True
+DEDUP_THRESHOLD = 0.8
+MINHASH_SIGNATURE_FILE = 'minhash_signatures.npz'
+RELEVANT_PAPER_IDS = []
+RELEVANCE_WEIGHT = 10.0
+RELEVANCE_EMBEDDING_DIM = 1024
+RELEVANCE_STORE_DIR = 'relevance'
@@ -4,7 +4,11 @@ import logging
 import pathlib
 import re
 import shutil
+import threading
+import time
 import urllib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from email.header import decode_header
 from functools import reduce
@@ -25,6 +29,9 @@ from whoosh.qparser import QueryParser
 from whoosh.query import Regex, Query
 from credentials import *
 from config import *
+from utils.metadata_store import open_metadata_store, arxiv_base_id, DEFAULT_STORE_PATH
+from utils.dedup import MinHashDeduplicator
+from utils.relevance import RelevanceModel
 import sys
 
 # add parent folder to python path for jinja to find it
@@ -152,38 +159,264 @@ def generate_website(fp, title, info, papers):
 
 
 ########################################################################################################################
-def fetch_arxiv_info(newsletters):
-  client = arxiv.Client(
-    page_size=1000,
-    delay_seconds=3,
-    num_retries=5
-  )
+class TokenBucket:
+  """Thread-safe token bucket limiting how often requests are issued to the arXiv API."""
+
+  def __init__(self, rate, capacity=1):
+    self.rate = rate
+    self.capacity = capacity
+    self._tokens = capacity
+    self._last = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    """Blocks until a token is available and consumes it."""
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        wait_s = (1 - self._tokens) / self.rate
+      time.sleep(wait_s)
+
+
+# shared by all fetchers, arXiv's limits apply per client host and not per request type
+ARXIV_BUCKET = TokenBucket(ARXIV_REQUESTS_PER_SECOND, ARXIV_REQUEST_BURST)
+# arXiv asks for a single connection at a time, the bucket alone only spaces out the start of requests
+ARXIV_CONNECTIONS = threading.Semaphore(ARXIV_MAX_CONNECTIONS)
+
 
-  paper_id_list = [p for nl in newsletters for p in nl.papers]
-  paper_chunks = [paper_id_list[i:i + MAX_ARXIV_REQUESTS] for i in range(0, len(paper_id_list), MAX_ARXIV_REQUESTS)]
-  papers = []
+########################################################################################################################
+def arxiv_request(client, search):
+  # holds a connection slot for the whole request, including the download of the response
+  with ARXIV_CONNECTIONS:
+    ARXIV_BUCKET.acquire()
+    return list(client.results(search))
 
-  for pchunk in paper_chunks:
-    search = arxiv.Search(id_list=pchunk, max_results=len(pchunk), sort_by=arxiv.SortCriterion.SubmittedDate)
 
-    for p in client.results(search):
-      authors = ', '.join([a.name for a in p.authors])
-      # search_string += tag
-      paper = Paper(paper_id=p.get_short_id(), title=p.title, abstract=p.summary.replace('\n', ' '), authors=authors,
-                    comment=p.comment, published=p.published, score=0.0, arxiv_url=p.entry_id,
-                    pdf_url=p.pdf_url, gs_url=create_gs_url(p.title))
-      papers.append(paper)
+########################################################################################################################
+def paper_from_arxiv_result(p, paper_id=None):
+  authors = ', '.join([a.name for a in p.authors])
+  return Paper(paper_id=p.get_short_id() if paper_id is None else paper_id, title=p.title,
+               abstract=p.summary.replace('\n', ' '), authors=authors, comment=p.comment, published=p.published,
+               score=0.0, arxiv_url=p.entry_id, pdf_url=p.pdf_url, gs_url=create_gs_url(p.title))
+
+
+########################################################################################################################
+def paper_from_metadata(record, paper_id=None):
+  # converts a record of the local metadata store, see utils/metadata_store.py
+  short_id = record['arxiv_id'] + record['version']
+  published = datetime.fromisoformat(record['published']) if record['published'] else None
+  return Paper(paper_id=short_id if paper_id is None else paper_id, title=record['title'], abstract=record['abstract'],
+               authors=record['authors'], comment=record['comment'], published=published, score=0.0,
+               arxiv_url=f'http://arxiv.org/abs/{short_id}', pdf_url=f'http://arxiv.org/pdf/{short_id}',
+               gs_url=create_gs_url(record['title']))
+
+
+########################################################################################################################
+def load_papers_from_cache(cache_fn):
+  """Loads papers persisted by `append_papers_to_cache`, later entries win."""
+  papers = {}
+  cache_fn = pathlib.Path(cache_fn)
+  if not cache_fn.exists():
+    return papers
+
+  with open(cache_fn, 'r', encoding='utf-8') as f:
+    for line in f:
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        data = json.loads(line)
+      except json.JSONDecodeError:
+        # a partially written last line of an interrupted run
+        logging.warning(f"Skipping corrupt line in paper cache '{cache_fn}'.")
+        continue
+      papers[data['key']] = Paper.from_dict(data['paper'])
+  return papers
+
+
+########################################################################################################################
+def append_papers_to_cache(cache_fn, papers):
+  """Appends papers, given as dict key -> Paper, to a JSON lines cache file."""
+  cache_fn = pathlib.Path(cache_fn)
+  cache_fn.parent.mkdir(parents=True, exist_ok=True)
+  with open(cache_fn, 'a', encoding='utf-8') as f:
+    for key, paper in papers.items():
+      f.write(json.dumps({'key': key, 'paper': paper.to_dict()}) + '\n')
+
+
+########################################################################################################################
+def is_arxiv_item_error(e):
+  # arXiv answers malformed or unknown ids with a 4xx, other errors (connection, 5xx, 429) are unrelated to the ids
+  status = getattr(e, 'status', None)
+  return isinstance(e, arxiv.HTTPError) and status is not None and 400 <= status < 500 and status != 429
+
+
+########################################################################################################################
+def iter_arxiv_chunks(chunks, fetch_chunk, workers=ARXIV_WORKERS, max_retries=ARXIV_CHUNK_RETRIES,
+                      max_failures=ARXIV_MAX_CONSECUTIVE_FAILURES, backoff=ARXIV_RETRY_BACKOFF_SECONDS):
+  """
+  Runs arXiv requests concurrently and yields the results of each chunk as soon as it is completed.
+  Parameters
+  ----------
+  chunks : list
+    A list of chunks, each a list of items (e.g. arXiv ids) handled by one request.
+  fetch_chunk : callable
+    Called with a chunk, returns a tuple (results, missing) where missing is the list of items that should be
+    requested again. It has to issue its requests through `arxiv_request`.
+  workers : int
+    The number of concurrent fetches, requests themselves are limited by `ARXIV_CONNECTIONS`.
+  max_retries : int
+    How often the same failed items are requested again before they are given up.
+  max_failures : int
+    The number of consecutive failed requests, after which fetching is aborted with a RuntimeError.
+  backoff : float
+    The initial delay in seconds before a failed request is retried, doubled with every consecutive failure.
+  Returns
+  -------
+  generator
+    Yields a tuple (results, num_done) for every completed request, where num_done is the number of items, which
+    are finished for good, i.e. fetched or given up.
+  """
+  pending = deque((chunk, 0) for chunk in chunks if chunk)
+  running = {}
+  failures = 0
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    while pending or running:
+      while pending and len(running) < workers:
+        chunk, attempt = pending.popleft()
+        running[executor.submit(fetch_chunk, chunk)] = (chunk, attempt)
+
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        chunk, attempt = running.pop(future)
+        try:
+          results, missing = future.result()
+        except Exception as e:
+          if is_arxiv_item_error(e):
+            # the request was rejected because of its items, split the chunk to isolate the bad ones
+            if len(chunk) > 1:
+              pending.extend((c, attempt) for c in (chunk[:len(chunk) // 2], chunk[len(chunk) // 2:]))
+              continue
+            logging.warning(f"Giving up on item '{chunk[0]}', rejected by arXiv ({e}).")
+            yield [], 1
+            continue
+
+          failures += 1
+          logging.warning(f"arXiv request for {len(chunk)} items failed ({e}), {failures} consecutive failures.")
+          if failures >= max_failures:
+            raise RuntimeError(f"Aborting after {failures} consecutive failed arXiv requests.") from e
+          time.sleep(min(backoff * 2 ** (failures - 1), 60))
+          results, missing = [], chunk
+        else:
+          failures = 0
+
+        num_done = len(chunk) - len(missing)
+        if missing:
+          if attempt < max_retries:
+            pending.append((missing, attempt + 1))
+          else:
+            logging.warning(f"Giving up on {len(missing)} items after {max_retries} retries.")
+            num_done = len(chunk)
+
+        if results or num_done:
+          yield results, num_done
+
+
+########################################################################################################################
+def fetch_arxiv_chunk(id_list):
+  client = arxiv.Client(page_size=len(id_list), delay_seconds=0, num_retries=0)
+  search = arxiv.Search(id_list=id_list, max_results=len(id_list), sort_by=arxiv.SortCriterion.SubmittedDate)
+
+  papers = [paper_from_arxiv_result(p) for p in arxiv_request(client, search)]
+  found_ids = {arxiv_base_id(p.paper_id) for p in papers}
+  missing = [pid for pid in id_list if arxiv_base_id(pid) not in found_ids]
+  return papers, missing
+
+
+########################################################################################################################
+def iter_arxiv_info(newsletters, cache_fn=pathlib.Path(PAPER_CACHE_DIR) / ARXIV_CACHE_FILE, store_fn=DEFAULT_STORE_PATH):
+  """
+  Fetches the arXiv information of all newsletters and yields each newsletter as soon as all of its papers are
+  available. Papers are taken from the local metadata store at `store_fn` first, if one was imported. Papers fetched
+  from the API are persisted to `cache_fn` after every chunk, such that an interrupted run only requests the missing
+  papers again.
+  """
+  cached_papers = load_papers_from_cache(cache_fn) if cache_fn else {}
+  paper_ids = [arxiv_base_id(p) for nl in newsletters for p in nl.papers]
+
+  store = open_metadata_store(store_fn)
+  if store is not None:
+    with store:
+      records = store.get_many(dict.fromkeys(paper_ids))
+    cached_papers.update({pid: paper_from_metadata(record) for pid, record in records.items()})
+    logging.info(f"Found {len(records)} papers in the metadata store '{store_fn}'.")
+  nl_ids = [[arxiv_base_id(p) for p in nl.papers] for nl in newsletters]
+  open_ids = [set(ids) - cached_papers.keys() for ids in nl_ids]
+
+  def finish(idx):
+    nl = newsletters[idx]
+    nl.papers = {cached_papers[pid].paper_id: cached_papers[pid] for pid in nl_ids[idx] if pid in cached_papers}
+    return nl
+
+  for idx in range(len(newsletters)):
+    if not open_ids[idx]:
+      yield finish(idx)
+
+  missing_ids = list(dict.fromkeys(pid for pid in paper_ids if pid not in cached_papers))
+  if missing_ids:
+    logging.info(f"Fetching {len(missing_ids)} papers from arXiv ({len(cached_papers)} cached) ...")
+  paper_chunks = [missing_ids[i:i + MAX_ARXIV_REQUESTS] for i in range(0, len(missing_ids), MAX_ARXIV_REQUESTS)]
+
+  for papers, _ in iter_arxiv_chunks(paper_chunks, fetch_arxiv_chunk):
+    papers = {arxiv_base_id(p.paper_id): p for p in papers}
+    cached_papers.update(papers)
+    if cache_fn:
+      append_papers_to_cache(cache_fn, papers)
+
+    for idx, ids in enumerate(open_ids):
+      if ids:
+        ids.difference_update(papers)
+        if not ids:
+          yield finish(idx)
+
+  # papers, which could not be fetched, are left out
+  for idx, ids in enumerate(open_ids):
+    if ids:
+      logging.warning(f"Could not fetch {len(ids)} papers of '{newsletters[idx].title}'.")
+      yield finish(idx)
+
+
+########################################################################################################################
+def fetch_arxiv_info(newsletters):
+  for _ in iter_arxiv_info(newsletters):
+    pass
 
 
-  cidx = 0
-  for nl in newsletters:
-    nl.papers = {p.paper_id: p for p in papers[cidx:cidx+len(nl.papers)]}
-    cidx += len(nl.papers)
+########################################################################################################################
+def create_relevance_model(index_dp=pathlib.Path(INDEX_DIR), cache_fn=pathlib.Path(PAPER_CACHE_DIR) / ARXIV_CACHE_FILE,
+                           store_fn=DEFAULT_STORE_PATH):
+  # resolves the relevant papers, which are not part of the scored collection, from the paper cache and metadata store
+  relevant_ids = {arxiv_base_id(pid) for pid in RELEVANT_PAPER_IDS}
+  known_papers = {pid: p for pid, p in load_papers_from_cache(cache_fn).items() if pid in relevant_ids}
+  store = open_metadata_store(store_fn)
+  if store is not None:
+    with store:
+      records = store.get_many(relevant_ids - known_papers.keys())
+    known_papers.update({pid: paper_from_metadata(record) for pid, record in records.items()})
 
+  return RelevanceModel(index_dp / RELEVANCE_STORE_DIR, RELEVANT_PAPER_IDS, known_papers.values(),
+                        dim=RELEVANCE_EMBEDDING_DIM)
 
 
 ########################################################################################################################
-def sort_and_create(output_dp, collections, index_dp=pathlib.Path(INDEX_DIR)):
+def sort_and_create(output_dp, collections, index_dp=pathlib.Path(INDEX_DIR), deduplicate=DEDUPLICATE_PAPERS,
+                    relevance_model=None):
   # search engine initialization
   stem_ana = StemmingAnalyzer()
   schema = Schema(paper_id=ID(stored=True, sortable=True),
@@ -201,9 +434,17 @@ def sort_and_create(output_dp, collections, index_dp=pathlib.Path(INDEX_DIR)):
   q = q_search_title | q_search_keywords | q_search_authors | q_search_conferences | \
       whoosh.query.Every('arxiv_url', boost=0.001)
   mw = scoring.MultiWeighting(scoring.BM25F())
+  deduplicator = MinHashDeduplicator(pathlib.Path(PAPER_CACHE_DIR) / MINHASH_SIGNATURE_FILE,
+                                     threshold=DEDUP_THRESHOLD) if deduplicate else None
+  if relevance_model is None and RELEVANT_PAPER_IDS:
+    relevance_model = create_relevance_model(index_dp)
 
   # search for keywords in each newsletter and create a website
   for col in collections:
+    if deduplicator is not None:
+      # collapse arXiv versions and conference/arXiv copies of the same work before indexing
+      col.papers = deduplicator.dedup(col.papers)
+
     msg_index_dp = index_dp / col.collection_id
     if msg_index_dp.exists():
       shutil.rmtree(msg_index_dp)
@@ -241,9 +482,19 @@ def sort_and_create(output_dp, collections, index_dp=pathlib.Path(INDEX_DIR)):
       papers.append(paper)
       logging.debug(paper.title, paper.authors, sep=' | ')
 
+    # blend the keyword score with the similarity to the papers marked as relevant
+    if relevance_model is not None:
+      similarities = relevance_model.score(papers)
+      for paper, similarity in zip(papers, similarities):
+        paper.score += RELEVANCE_WEIGHT * float(similarity)
+      papers.sort(key=lambda p: p.score, reverse=True)
+
     output_fn = output_dp / (col.collection_id + '.html')
     generate_website(output_fn, col.title, col.info, papers)
 
+  if deduplicator is not None:
+    deduplicator.save()
+
 
 ########################################################################################################################
 def fetch_newsletter_from_imap(server_name, username, password, mailfolder, last_n_newsletter, filter_seen=False):
@@ -306,7 +557,10 @@ def main():
   if IGNORE_ALREADY_CREATED:
     newsletters = [nl for nl in newsletters if not (output_dp / (nl.collection_id + '.html')).exists()]
 
-  fetch_arxiv_info(newsletters)
+  # index and render each newsletter as soon as its papers arrived, while the remaining ones are still fetched
+  relevance_model = create_relevance_model() if RELEVANT_PAPER_IDS else None
+  for nl in iter_arxiv_info(newsletters):
+    sort_and_create(output_dp, [nl], relevance_model=relevance_model)
 
   # add "overview newsletter" containing all papers, only reasonable if there are more than one newsletter
   if CREATE_OVERVIEW and len(newsletters) > 1:
@@ -321,9 +575,7 @@ def main():
 
     overview_id = 'ov_' + to_date.strftime("%Y%m%d%H%M") + ('_%dnl' % len(newsletters))
     overview_collection = PaperCollection(collection_id=overview_id, title=title, info=info, published=to_date, papers=papers)
-    newsletters.append(overview_collection)
-
-  sort_and_create(output_dp, newsletters)
+    sort_and_create(output_dp, [overview_collection], relevance_model=relevance_model)
 
 
 ########################################################################################################################
@@ -1,8 +1,8 @@
 import csv
 import logging
 import pathlib
-import pickle
 import sys
+from contextlib import nullcontext
 from datetime import datetime
 from arxiv import arxiv
 
@@ -19,7 +19,9 @@ def _init_logger():
 _logger = _init_logger()
 
 from config import OUTPUT_DIR, INDEX_DIR, PAPER_CACHE_DIR
-from organizer import PaperCollection, sort_and_create, Paper, create_gs_url
+from organizer import PaperCollection, sort_and_create, Paper, create_gs_url, paper_from_arxiv_result, \
+  paper_from_metadata, iter_arxiv_chunks, load_papers_from_cache, append_papers_to_cache, arxiv_request
+from utils.metadata_store import open_metadata_store, DEFAULT_STORE_PATH
 
 import requests
 from bs4 import BeautifulSoup
@@ -33,13 +35,28 @@ ECVA_PAPERS_URL = "https://www.ecva.net"
 NEURIPS_PAPERS_URL = "https://proceedings.neurips.cc"
 
 
+########################################################################################################################
+def find_paper_offline(store, title, fuzzy_th=90, paper_id=None):
+  # looks up a title in the local metadata store, returns None if there is no store or no match
+  if store is None:
+    return None
+  candidates = [(fuzz.ratio(title.lower(), record['title'].lower()), record) for record in store.find_by_title(title)]
+  ratio, record = max(candidates, key=lambda c: c[0], default=(0, None))
+  if ratio > fuzzy_th:
+    return paper_from_metadata(record, paper_id=paper_id)
+  return None
+
+
 ########################################################################################################################
 def fetch_papers_from_csv(csv_file, delimiter=',', quotechar='"', encoding=None, fuzzy_th=90,
-                              filter_fn=lambda x: True):
+                              filter_fn=lambda x: True, store_fn=DEFAULT_STORE_PATH):
   # fetches archive information from a csv, which needs to have field Title
   papers = {}
   not_found_papers = {}
-  with open(csv_file, newline='', encoding=encoding) as csvfile:
+  # an explicit check, the truthiness of a store would count all of its records
+  store = open_metadata_store(store_fn)
+  with store if store is not None else nullcontext(), \
+       open(csv_file, newline='', encoding=encoding) as csvfile:
     reader = csv.DictReader(csvfile, delimiter=delimiter, quotechar=quotechar)
     for row in tqdm(reader):
       if filter_fn(row):
@@ -47,6 +64,12 @@ def fetch_papers_from_csv(csv_file, delimiter=',', quotechar='"', encoding=None,
                                                   authors=row['Authors'].replace(';', ','), comment='ICCV 2021',
                                                   gs_url=create_gs_url(row['Title']))
 
+        paper = find_paper_offline(store, row['Title'], fuzzy_th)
+        if paper is not None:
+          del not_found_papers[row['Paper ID']]
+          papers[paper.paper_id] = paper
+          continue
+
         logging.info(f"Searching for paper with title '{row['Title']}' ...")
         search = arxiv.Search(query='ti:%s' % row['Title'].replace(':', ''), max_results=10)
         results = list(search.results())
@@ -60,21 +83,29 @@ def fetch_papers_from_csv(csv_file, delimiter=',', quotechar='"', encoding=None,
                           comment=p.comment, arxiv_url=p.entry_id, pdf_url=p.pdf_url, gs_url=create_gs_url(p.title), published=p.published)
             papers[p.get_short_id()] = paper
             break
-          
+
   return {**papers, **not_found_papers}
 
 
 ########################################################################################################################
-def fetch_papers_from_text(text_file, encoding=None, fuzzy_th=90):
+def fetch_papers_from_text(text_file, encoding=None, fuzzy_th=90, store_fn=DEFAULT_STORE_PATH):
   # fetches archive information from a csv, which needs to have field Title
   papers = {}
   not_found_papers = {}
-  with open(text_file, newline='', encoding=encoding) as txtfile:
+  store = open_metadata_store(store_fn)
+  with store if store is not None else nullcontext(), \
+       open(text_file, newline='', encoding=encoding) as txtfile:
     for idx, title in tqdm(enumerate(txtfile)):
       title = title.strip()
       paper_id = '%05d' % idx
       not_found_papers[paper_id] = Paper(paper_id=paper_id, title=title, gs_url=create_gs_url(title))
 
+      paper = find_paper_offline(store, title, fuzzy_th)
+      if paper is not None:
+        del not_found_papers[paper_id]
+        papers[paper.paper_id] = paper
+        continue
+
       logging.info(f"Searching for paper with title '{title}' ...")
       search = arxiv.Search(query='ti:%s' % title.replace(':', ''), max_results=10)
       results = list(search.results())
@@ -89,6 +120,7 @@ def fetch_papers_from_text(text_file, encoding=None, fuzzy_th=90):
                         published=p.published)
           papers[p.get_short_id()] = paper
           break
+
   return {**papers, **not_found_papers}
 
 
@@ -169,36 +201,51 @@ def parse_neurips(year):
 
 
 ########################################################################################################################
-def fetch_papers_from_title(papers, fuzzy_th=90, max_requests=1):
-  client = arxiv.Client(
-    page_size=1000,
-    delay_seconds=3,
-    num_retries=5
-  )
-  not_found_papers = {paper.paper_id: paper for paper in papers}
-  paper_chunks = [papers[i:i + max_requests] for i in range(0, len(papers), max_requests)]
-  for chunk in tqdm(paper_chunks):
-    titles = [paper.title for paper in chunk]
-    search_query = ' OR '.join([f'(ti:{title})' for title in titles])
+def fetch_papers_from_title(papers, fuzzy_th=90, max_requests=1, cache_fn=None, store_fn=DEFAULT_STORE_PATH):
+  # papers already matched in a previous (interrupted) run are loaded from cache_fn and not requested again
+  found_papers = load_papers_from_cache(cache_fn) if cache_fn else {}
+  not_found_papers = {paper.paper_id: paper for paper in papers if str(paper.paper_id) not in found_papers}
+
+  store = open_metadata_store(store_fn)
+  if store is not None:
+    with store:
+      for paper_id, paper in list(not_found_papers.items()):
+        paper = find_paper_offline(store, paper.title, fuzzy_th, paper_id=paper_id)
+        if paper is not None:
+          found_papers[str(paper_id)] = paper
+          del not_found_papers[paper_id]
+
+  open_papers = list(not_found_papers.values())
+  paper_chunks = [open_papers[i:i + max_requests] for i in range(0, len(open_papers), max_requests)]
+
+  def fetch_chunk(chunk):
+    client = arxiv.Client(page_size=max_requests*10, delay_seconds=0, num_retries=0)
+    search_query = ' OR '.join([f'(ti:{paper.title})' for paper in chunk])
     search = arxiv.Search(query=search_query, max_results=max_requests*10)
-    for p in client.results(search):
-      for paper in chunk:
+
+    fetched_papers, unmatched = [], list(chunk)
+    for p in arxiv_request(client, search):
+      for paper in unmatched:
         if fuzz.ratio(paper.title.lower(), p.title.lower()) > fuzzy_th:
           logging.info(f"Found paper with title '{paper.title}'.")
-
-          paper_id = paper.paper_id
-          authors = ', '.join([a.name for a in p.authors])
-          paper = Paper(paper_id=paper_id, title=p.title, abstract=p.summary.replace('\n', ' '), authors=authors,
-                        comment=p.comment, arxiv_url=p.entry_id, pdf_url=p.pdf_url,
-                        gs_url=create_gs_url(p.title), published=p.published)
-          del not_found_papers[paper_id]
-          papers[paper_id] = paper
-          pickle.dump(papers, open('papers.pkl', 'wb'))
-          test = pickle.load(open('papers.pkl', 'rb'))
+          fetched_papers.append(paper_from_arxiv_result(p, paper_id=paper.paper_id))
+          unmatched.remove(paper)
           break
-    print('')
+    # titles without a match are most likely not on arXiv, requesting them again would not help
+    return fetched_papers, []
 
-  return {**papers, **not_found_papers}
+  progress = tqdm(total=len(open_papers))
+  for fetched_papers, num_done in iter_arxiv_chunks(paper_chunks, fetch_chunk):
+    progress.update(num_done)
+    fetched_papers = {str(paper.paper_id): paper for paper in fetched_papers}
+    found_papers.update(fetched_papers)
+    if cache_fn:
+      append_papers_to_cache(cache_fn, fetched_papers)
+    for paper in fetched_papers.values():
+      not_found_papers.pop(paper.paper_id, None)
+  progress.close()
+
+  return {**{paper.paper_id: paper for paper in found_papers.values()}, **not_found_papers}
 
 
 ########################################################################################################################
@@ -210,7 +257,8 @@ def parse_cvpr(conference, url, fuzzy_th=90, max_requests=50):
   title_author_list = [(ti_el.text, au_el.text.replace(' ·', ',')) for ti_el, au_el in title_author_list 
                        if ti_el is not None]
   papers = [Paper(idx, title=ti, authors=au) for idx, (ti, au) in enumerate(title_author_list)]
-  fetched_papers = fetch_papers_from_title(papers)
+  cache_fn = pathlib.Path('.') / PAPER_CACHE_DIR / f"{conference.replace(' ', '_').lower()}_arxiv.jsonl"
+  fetched_papers = fetch_papers_from_title(papers, fuzzy_th=fuzzy_th, cache_fn=cache_fn)
   
   return fetched_papers
 
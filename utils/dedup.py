@@ -0,0 +1,186 @@
+import difflib
+import hashlib
+import logging
+import os
+import pathlib
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from utils.metadata_store import normalize_title, arxiv_base_id, arxiv_version, arxiv_id_from_url
+
+# Mersenne prime, a * x + b stays below 2**63 for 31 bit a, b and 32 bit shingle hashes
+_MERSENNE_PRIME = (1 << 31) - 1
+_SEED = 20240101
+LINK_FIELDS = ['arxiv_url', 'pdf_url', 'pub_url', 'supp_url', 'reviews_url']
+
+
+########################################################################################################################
+def _arxiv_key(paper):
+  # the arXiv id without version, taken from the arXiv url, which is also set for conference papers linking to arXiv
+  arxiv_id = arxiv_id_from_url(paper.arxiv_url)
+  return arxiv_base_id(arxiv_id) if arxiv_id else None
+
+
+########################################################################################################################
+def _version(paper):
+  return arxiv_version(arxiv_id_from_url(paper.arxiv_url) or '')
+
+
+########################################################################################################################
+class MinHashDeduplicator:
+  """
+  Collapses near-duplicate papers, i.e. papers with the same arXiv id, papers with the same normalized title and, if
+  both have an abstract, a MinHash estimated Jaccard similarity of their abstracts above `threshold`, or papers with
+  such abstracts and similar titles. Papers with different arXiv ids are never merged. Signatures are keyed by the
+  digest of the abstract and persisted to `cache_fn`, such that they are computed only once across runs.
+  """
+
+  def __init__(self, cache_fn=None, num_perm=64, bands=16, shingle_size=3, threshold=0.8, title_threshold=0.7,
+               min_abstract_words=20):
+    assert num_perm % bands == 0, 'num_perm has to be divisible by bands'
+    self.cache_fn = pathlib.Path(cache_fn) if cache_fn else None
+    self.bands = bands
+    self.shingle_size = shingle_size
+    self.threshold = threshold
+    self.title_threshold = title_threshold
+    # short abstracts, e.g. "This paper has been withdrawn.", are boilerplate and say nothing about the work
+    self.min_abstract_words = min_abstract_words
+    # everything the signatures depend on, persisted signatures computed with other parameters are invalid
+    self._params = np.array([num_perm, shingle_size, _SEED, _MERSENNE_PRIME], dtype=np.int64)
+
+    rng = np.random.default_rng(_SEED)
+    self._a = rng.integers(1, _MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+    self._b = rng.integers(0, _MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+    self._signatures = {}
+    self._dirty = False
+
+    if self.cache_fn and self.cache_fn.exists():
+      try:
+        with np.load(self.cache_fn) as data:
+          if 'params' in data.files and np.array_equal(data['params'], self._params):
+            self._signatures = dict(zip(data['keys'].tolist(), data['signatures']))
+          else:
+            logging.info(f"Discarding MinHash signatures in '{self.cache_fn}', computed with other parameters.")
+      except Exception as e:
+        # the signatures are only a cache, they are simply computed again
+        logging.warning(f"Could not read MinHash signatures from '{self.cache_fn}' ({e}), starting with an empty cache.")
+
+  def save(self):
+    if not (self.cache_fn and self._dirty):
+      return
+    self.cache_fn.parent.mkdir(parents=True, exist_ok=True)
+    keys = list(self._signatures)
+    # written to a temporary file first, such that an interrupted save does not corrupt the cache
+    tmp_fn = self.cache_fn.with_name(self.cache_fn.name + '.tmp')
+    with open(tmp_fn, 'wb') as f:
+      np.savez(f, params=self._params, keys=np.array(keys),
+               signatures=np.stack([self._signatures[k] for k in keys]))
+    os.replace(tmp_fn, self.cache_fn)
+    self._dirty = False
+
+  def signature(self, text):
+    words = normalize_title(text).split()
+    shingles = {' '.join(words[i:i + self.shingle_size]) for i in range(max(1, len(words) - self.shingle_size + 1))}
+    key = hashlib.sha1(' '.join(words).encode('utf-8')).hexdigest()
+
+    if key not in self._signatures:
+      # crc32 instead of hash(), which is salted per process and would invalidate the persisted signatures
+      hashes = np.array([zlib.crc32(s.encode('utf-8')) for s in shingles], dtype=np.uint64)
+      self._signatures[key] = ((self._a * hashes[None, :] + self._b) % _MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+      self._dirty = True
+    return self._signatures[key]
+
+  def _similar_titles(self, paper, other):
+    title, other_title = normalize_title(paper.title or ''), normalize_title(other.title or '')
+    return difflib.SequenceMatcher(None, title, other_title).ratio() >= self.title_threshold
+
+  def dedup(self, papers):
+    """
+    Collapses near-duplicate papers.
+    Parameters
+    ----------
+    papers : dict
+      The papers of a collection, keyed by paper id.
+    Returns
+    -------
+    dict
+      The remaining papers, each one merged with the links of its duplicates.
+    """
+    keys = list(papers)
+    parent = list(range(len(keys)))
+    # the arXiv id of each group, indexed by its root
+    group_arxiv_keys = [_arxiv_key(papers[k]) for k in keys]
+
+    def find(i):
+      while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+      return i
+
+    def union(i, j):
+      root_i, root_j = find(i), find(j)
+      arxiv_i, arxiv_j = group_arxiv_keys[root_i], group_arxiv_keys[root_j]
+      # never join two different arXiv papers, not even through a third paper without arXiv id
+      if root_i == root_j or (arxiv_i and arxiv_j and arxiv_i != arxiv_j):
+        return
+      parent[root_j] = root_i
+      group_arxiv_keys[root_i] = arxiv_i or arxiv_j
+
+    def similar_abstracts(i, j):
+      return i in signatures and j in signatures and np.mean(signatures[i] == signatures[j]) >= self.threshold
+
+    # candidates: same normalized title, same arXiv id or same MinHash band
+    buckets = defaultdict(list)
+    signatures = {}
+    for idx, key in enumerate(keys):
+      paper = papers[key]
+      if paper.title and normalize_title(paper.title):
+        buckets[('title', normalize_title(paper.title))].append(idx)
+      if group_arxiv_keys[idx]:
+        buckets[('arxiv', group_arxiv_keys[idx])].append(idx)
+      if paper.abstract and len(normalize_title(paper.abstract).split()) >= self.min_abstract_words:
+        signatures[idx] = self.signature(paper.abstract)
+        for band, rows in enumerate(np.split(signatures[idx], self.bands)):
+          buckets[('band', band, rows.tobytes())].append(idx)
+
+    for (kind, *_), members in buckets.items():
+      for i, idx in enumerate(members):
+        for jdx in members[i + 1:]:
+          paper, other = papers[keys[idx]], papers[keys[jdx]]
+          if kind == 'arxiv':
+            union(idx, jdx)
+          elif kind == 'title':
+            # the same title is enough only if there are no abstracts to compare, e.g. for conference lists
+            if not (paper.abstract and other.abstract) or similar_abstracts(idx, jdx):
+              union(idx, jdx)
+          elif similar_abstracts(idx, jdx) and self._similar_titles(paper, other):
+            # sharing a band is only a candidate, the estimated Jaccard similarity and the titles decide
+            union(idx, jdx)
+
+    groups = defaultdict(list)
+    for idx in range(len(keys)):
+      groups[find(idx)].append(keys[idx])
+
+    deduped = {}
+    for group in groups.values():
+      group_papers = [papers[k] for k in group]
+      # the arXiv entry with the latest version and the longest abstract is kept, the others only contribute links
+      primary_idx = max(range(len(group)), key=lambda i: (group_papers[i].arxiv_url is not None,
+                                                            _version(group_papers[i]),
+                                                            len(group_papers[i].abstract or '')))
+      primary = group_papers[primary_idx]
+      for paper in group_papers:
+        if paper is primary:
+          continue
+        for field in LINK_FIELDS + ['abstract', 'authors', 'published']:
+          if getattr(primary, field) is None:
+            setattr(primary, field, getattr(paper, field))
+        if paper.comment and paper.comment not in (primary.comment or ''):
+          primary.comment = '; '.join(c for c in (primary.comment, paper.comment) if c)
+      deduped[group[primary_idx]] = primary
+
+    if len(deduped) < len(papers):
+      logging.info(f"Collapsed {len(papers) - len(deduped)} duplicate papers, {len(deduped)} remaining.")
+    return deduped
@@ -0,0 +1,227 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import pathlib
+import re
+import sqlite3
+import sys
+import time
+from email.utils import parsedate_to_datetime
+
+# add parent folder to python path for the config to be found when run as a script
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parents[1]))
+
+from config import PAPER_CACHE_DIR, METADATA_STORE_FILE
+
+logging.basicConfig(level=logging.INFO)
+DEFAULT_STORE_PATH = pathlib.Path(PAPER_CACHE_DIR) / METADATA_STORE_FILE
+IMPORT_BATCH_SIZE = 10000
+# stay below SQLite's limit of host parameters per statement
+LOOKUP_BATCH_SIZE = 500
+TITLE_CANDIDATES = 10
+# the fuzzy fallback only searches for the rarest words of a title, common ones would match most of the store
+RARE_TITLE_WORDS = 3
+RARE_WORD_MAX_DOCS = 20000
+FIELDS = ['arxiv_id', 'version', 'title', 'abstract', 'authors', 'comment', 'published']
+
+
+########################################################################################################################
+def normalize_title(title):
+  # lower case alphanumeric words only, such that formatting and punctuation differences do not matter
+  return ' '.join(re.findall(r'[a-z0-9]+', title.lower()))
+
+
+########################################################################################################################
+def arxiv_base_id(paper_id):
+  # strips the version suffix, e.g. 2301.12345v2 -> 2301.12345
+  return re.sub(r'v\d+$', '', str(paper_id))
+
+
+########################################################################################################################
+def arxiv_version(paper_id):
+  # the version number of an arXiv id, 0 if it has none
+  match = re.search(r'v(\d+)$', str(paper_id))
+  return int(match.group(1)) if match else 0
+
+
+########################################################################################################################
+def arxiv_id_from_url(url):
+  # e.g. http://arxiv.org/abs/2301.12345v2 -> 2301.12345v2, http://arxiv.org/abs/hep-ph/0703001 -> hep-ph/0703001
+  match = re.search(r'arxiv\.org/(?:abs|pdf)/(.+?)(?:\.pdf)?/?$', url or '')
+  return match.group(1) if match else None
+
+
+########################################################################################################################
+def _parse_snapshot_record(line):
+  data = json.loads(line)
+  title = ' '.join(data['title'].split())
+
+  if data.get('authors_parsed'):
+    authors = ', '.join(' '.join(part for part in (first, last, *suffix) if part)
+                        for last, first, *suffix in data['authors_parsed'])
+  else:
+    authors = ' '.join(data.get('authors', '').split())
+
+  versions = data.get('versions') or []
+  version = versions[-1]['version'] if versions else 'v1'
+  published = parsedate_to_datetime(versions[0]['created']).isoformat() if versions else None
+
+  return (data['id'], version, title, normalize_title(title), ' '.join(data.get('abstract', '').split()), authors,
+          data.get('comments'), published)
+
+
+########################################################################################################################
+class MetadataStore:
+  """Local SQLite store of arXiv metadata, imported from the public bulk metadata snapshot."""
+
+  def __init__(self, db_path=DEFAULT_STORE_PATH):
+    self.db_path = pathlib.Path(db_path)
+    self.db_path.parent.mkdir(parents=True, exist_ok=True)
+    self.conn = sqlite3.connect(str(self.db_path))
+    self.conn.execute('CREATE TABLE IF NOT EXISTS papers (arxiv_id TEXT PRIMARY KEY, version TEXT, title TEXT, '
+                      'norm_title TEXT, abstract TEXT, authors TEXT, comment TEXT, published TEXT)')
+    # full text index on the title words, used to find candidates for fuzzy title matching
+    self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(norm_title, content='papers', "
+                      "content_rowid='rowid')")
+    self.conn.execute('CREATE TABLE IF NOT EXISTS title_words (word TEXT PRIMARY KEY, docs INTEGER)')
+
+  def close(self):
+    self.conn.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return self.conn.execute('SELECT COUNT(*) FROM papers').fetchone()[0]
+
+  def bulk_import(self, snapshot_fn):
+    """
+    Streams a (gzip-compressed) arXiv metadata snapshot in JSON lines format into the store. Use `import_snapshot`
+    to replace the store only after a successful import.
+    Parameters
+    ----------
+    snapshot_fn : str
+      The file path of the snapshot, e.g. arxiv-metadata-oai-snapshot.json.gz.
+    Returns
+    -------
+    int
+      The number of imported records.
+    """
+    snapshot_fn = pathlib.Path(snapshot_fn)
+    open_fn = gzip.open if snapshot_fn.suffix == '.gz' else open
+    start = time.monotonic()
+
+    # durability is not needed during the import, an interrupted import is simply restarted
+    self.conn.execute('PRAGMA journal_mode = OFF')
+    self.conn.execute('PRAGMA synchronous = OFF')
+    # the title indices are cheaper to build once after the bulk insert than to maintain row by row
+    self.conn.execute('DROP INDEX IF EXISTS papers_norm_title')
+
+    count = 0
+    batch = []
+    with open_fn(snapshot_fn, 'rt', encoding='utf-8') as f:
+      for line in f:
+        if not line.strip():
+          continue
+        batch.append(_parse_snapshot_record(line))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+          count += self._insert(batch)
+          batch = []
+          if count % (10 * IMPORT_BATCH_SIZE) == 0:
+            logging.info(f"Imported {count} records ({time.monotonic() - start:.0f}s) ...")
+      count += self._insert(batch)
+
+    self.conn.execute('CREATE INDEX papers_norm_title ON papers (norm_title)')
+    self.conn.execute("INSERT INTO papers_fts(papers_fts) VALUES ('rebuild')")
+    # document frequencies of the title words, the fts5vocab table itself can only be scanned
+    self.conn.execute("CREATE VIRTUAL TABLE temp.papers_fts_vocab USING fts5vocab(main, papers_fts, 'row')")
+    self.conn.execute('INSERT OR REPLACE INTO title_words SELECT term, doc FROM temp.papers_fts_vocab')
+    self.conn.commit()
+    self.conn.execute('PRAGMA synchronous = FULL')
+    logging.info(f"Imported {count} records from '{snapshot_fn}' in {time.monotonic() - start:.0f}s.")
+    return count
+
+  def _insert(self, batch):
+    with self.conn:
+      self.conn.executemany('INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?, ?, ?, ?)', batch)
+    return len(batch)
+
+  def get_many(self, arxiv_ids):
+    """Returns a dict mapping each known arXiv id (without version) to its record."""
+    arxiv_ids = list(arxiv_ids)
+    records = {}
+    for i in range(0, len(arxiv_ids), LOOKUP_BATCH_SIZE):
+      chunk = arxiv_ids[i:i + LOOKUP_BATCH_SIZE]
+      rows = self.conn.execute(f'SELECT {", ".join(FIELDS)} FROM papers WHERE arxiv_id IN '
+                               f'({", ".join("?" * len(chunk))})', chunk)
+      records.update({row[0]: dict(zip(FIELDS, row)) for row in rows})
+    return records
+
+  def find_by_title(self, title, limit=TITLE_CANDIDATES):
+    """
+    Returns candidate records for a title, the caller decides with a fuzzy ratio which one matches. Candidates are
+    the records with the same normalized title, else the ones containing all words of the title (e.g. arXiv titles
+    with additional LaTeX), else the best ranked ones containing any of its rarest words (e.g. typos).
+    """
+    norm_title = normalize_title(title)
+    rows = self.conn.execute(f'SELECT {", ".join(FIELDS)} FROM papers WHERE norm_title = ?', (norm_title,)).fetchall()
+    if rows or not norm_title:
+      return [dict(zip(FIELDS, row)) for row in rows]
+
+    words = list(dict.fromkeys(norm_title.split()))
+    rows = self._match_title(' '.join(f'"{w}"' for w in words), limit)
+    if not rows:
+      # misspelled words are not in the vocabulary at all
+      rare_words = self.conn.execute(f'SELECT word FROM title_words WHERE word IN ({", ".join("?" * len(words))}) '
+                                     f'AND docs <= ? ORDER BY docs LIMIT ?',
+                                     (*words, RARE_WORD_MAX_DOCS, RARE_TITLE_WORDS)).fetchall()
+      if rare_words:
+        rows = self._match_title(' OR '.join(f'"{w}"' for w, in rare_words), limit)
+    return [dict(zip(FIELDS, row)) for row in rows]
+
+  def _match_title(self, fts_query, limit):
+    return self.conn.execute(f'SELECT {", ".join("papers." + f for f in FIELDS)} FROM papers_fts '
+                             f'JOIN papers ON papers.rowid = papers_fts.rowid WHERE papers_fts MATCH ? '
+                             f'ORDER BY rank LIMIT ?', (fts_query, limit)).fetchall()
+
+
+########################################################################################################################
+def import_snapshot(snapshot_fn, db_path=DEFAULT_STORE_PATH):
+  # imports into a temporary file, such that an interrupted import never replaces a valid store
+  db_path = pathlib.Path(db_path)
+  tmp_path = db_path.with_name(db_path.name + '.tmp')
+  if tmp_path.exists():
+    tmp_path.unlink()
+
+  with MetadataStore(tmp_path) as store:
+    count = store.bulk_import(snapshot_fn)
+  os.replace(tmp_path, db_path)
+  return count
+
+
+########################################################################################################################
+def open_metadata_store(db_path=DEFAULT_STORE_PATH):
+  # the store is optional, without an imported snapshot (or with db_path None) everything is fetched from the arXiv API
+  if db_path is None or not pathlib.Path(db_path).exists():
+    return None
+  return MetadataStore(db_path)
+
+
+########################################################################################################################
+def main():
+  parser = argparse.ArgumentParser(description='Imports an arXiv metadata snapshot into the local metadata store.')
+  parser.add_argument('snapshot', help='the arXiv metadata snapshot, JSON lines, optionally gzip-compressed')
+  parser.add_argument('--store', default=str(DEFAULT_STORE_PATH), help='the SQLite file of the metadata store')
+  args = parser.parse_args()
+
+  import_snapshot(args.snapshot, args.store)
+
+
+########################################################################################################################
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import pathlib
+import zlib
+
+import numpy as np
+
+from utils.metadata_store import normalize_title, arxiv_base_id
+
+VECTORS_FILE = 'vectors.f32'
+KEYS_FILE = 'keys.tsv'
+PARAMS_FILE = 'params.json'
+# bump whenever `embed` changes, vectors of another embedding are not comparable
+EMBEDDING_VERSION = 'hashed-uni-bigrams-crc32-log-v1'
+
+
+########################################################################################################################
+def _content_key(paper):
+  # papers are identified by their content, since conference paper ids are only unique within one collection
+  text = normalize_title(paper.title or '') + '\t' + normalize_title(paper.abstract or '')
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+########################################################################################################################
+def embed(texts, dim):
+  """
+  Embeds texts with signed feature hashing of word uni- and bigrams, log-scaled and L2 normalized. Deterministic and
+  without any fitting, such that vectors stay valid when new papers are added.
+  """
+  vectors = np.zeros((len(texts), dim), dtype=np.float32)
+  for row, text in enumerate(texts):
+    words = normalize_title(text).split()
+    for feature in words + [a + ' ' + b for a, b in zip(words, words[1:])]:
+      h = zlib.crc32(feature.encode('utf-8'))
+      vectors[row, h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+
+  vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+  norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+  return vectors / np.maximum(norms, 1e-12)
+
+
+########################################################################################################################
+class RelevanceModel:
+  """
+  Scores papers by their cosine similarity to the centroid of papers marked as relevant. Paper vectors are kept in an
+  append-only, memory-mapped float32 matrix in `store_dp`, such that each paper is embedded only once. Vectors are
+  keyed by content, relevant papers are resolved by paper id among `known_papers` (e.g. from the paper cache) and the
+  papers of the scored collection.
+  """
+
+  def __init__(self, store_dp, relevant_paper_ids, known_papers=None, dim=1024):
+    self.store_dp = pathlib.Path(store_dp)
+    self.store_dp.mkdir(parents=True, exist_ok=True)
+    self.relevant_ids = {arxiv_base_id(pid) for pid in relevant_paper_ids}
+    self.known_papers = {arxiv_base_id(p.paper_id): p for p in (known_papers or [])
+                         if arxiv_base_id(p.paper_id) in self.relevant_ids}
+    self.dim = dim
+    self._keys = {}
+    self._vectors = None
+    self._check_params()
+    self._load()
+
+  def _check_params(self):
+    # the raw matrix has no shape, vectors stored with another dimension or embedding would be misread
+    params = {'dim': self.dim, 'embedding': EMBEDDING_VERSION}
+    params_fn = self.store_dp / PARAMS_FILE
+    try:
+      stored_params = json.loads(params_fn.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+      stored_params = None
+    if stored_params == params:
+      return
+
+    if (self.store_dp / VECTORS_FILE).exists() or (self.store_dp / KEYS_FILE).exists():
+      logging.info(f"Rebuilding the relevance store '{self.store_dp}', it was created with other parameters.")
+    for fn in (VECTORS_FILE, KEYS_FILE):
+      (self.store_dp / fn).unlink(missing_ok=True)
+    params_fn.write_text(json.dumps(params), encoding='utf-8')
+
+  def _load(self):
+    keys_fn = self.store_dp / KEYS_FILE
+    vectors_fn = self.store_dp / VECTORS_FILE
+    lines = keys_fn.read_text(encoding='utf-8').splitlines() if keys_fn.exists() else []
+    num_rows = vectors_fn.stat().st_size // (4 * self.dim) if vectors_fn.exists() else 0
+
+    # keys are written after the vectors, an interrupted append leaves at most rows without a key
+    num_rows = min(num_rows, len(lines))
+    # the paper id is only informative, the same content may appear under different ids
+    self._keys = {line.split('\t')[0]: row for row, line in enumerate(lines[:num_rows])}
+    self._vectors = np.memmap(vectors_fn, dtype=np.float32, mode='r', shape=(num_rows, self.dim)) \
+      if num_rows else np.zeros((0, self.dim), dtype=np.float32)
+
+  def _append(self, papers):
+    keys = [_content_key(p) for p in papers]
+    new = {}
+    for key, paper in zip(keys, papers):
+      if key not in self._keys and key not in new:
+        new[key] = paper
+    if new:
+      logging.info(f"Embedding {len(new)} new papers for the relevance model ...")
+      vectors = embed([(p.title or '') + ' ' + (p.abstract or '') for p in new.values()], self.dim)
+      # release the memory map before the file is modified
+      self._vectors = None
+      # drop rows of an interrupted append, which have no key
+      with open(self.store_dp / VECTORS_FILE, 'ab') as f:
+        f.truncate(len(self._keys) * 4 * self.dim)
+        f.write(vectors.tobytes())
+      with open(self.store_dp / KEYS_FILE, 'a', encoding='utf-8') as f:
+        f.writelines(f'{key}\t{paper.paper_id}\n' for key, paper in new.items())
+      self._load()
+    return np.array([self._keys[key] for key in keys], dtype=np.int64)
+
+  def score(self, papers):
+    """
+    Scores papers against the relevant papers.
+    Parameters
+    ----------
+    papers : list
+      The papers to be scored, missing ones are embedded and appended to the store.
+    Returns
+    -------
+    np.ndarray
+      The cosine similarity of each paper to the relevance profile, zero if no relevant paper could be found.
+    """
+    relevant = dict(self.known_papers)
+    relevant.update({arxiv_base_id(p.paper_id): p for p in papers if arxiv_base_id(p.paper_id) in self.relevant_ids})
+    unresolved = self.relevant_ids - relevant.keys()
+    if unresolved:
+      logging.info(f"Relevant papers not found in the collection or the paper cache: {', '.join(sorted(unresolved))}")
+
+    rows = self._append(list(papers) + list(relevant.values()))
+    paper_rows, relevant_rows = rows[:len(papers)], rows[len(papers):]
+    if not len(relevant_rows):
+      logging.warning('None of the relevant papers could be found, relevance scores are zero.')
+      return np.zeros(len(papers), dtype=np.float32)
+
+    profile = np.asarray(self._vectors[relevant_rows]).mean(axis=0)
+    profile /= max(np.linalg.norm(profile), 1e-12)
+    return np.asarray(self._vectors[paper_rows]) @ profile